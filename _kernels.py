@@ -0,0 +1,161 @@
+"""
+_kernels.py
+
+Numeric kernels, sample buffers and iterparse helpers shared by the
+activity parsers. The kernels are compiled with numba when it is installed
+and otherwise run as plain Python.
+"""
+
+import math
+import numpy as np
+
+try:
+    from numba import njit
+    HAVE_NUMBA = True
+except ImportError:  # numba is optional
+    HAVE_NUMBA = False
+    def njit(*args, **kwargs):
+        if args and callable(args[0]):
+            return args[0]
+        return lambda fn: fn
+
+
+def release_element(elem):
+    """Clear a handled element and drop the already-handled siblings before it.
+
+    clear() alone leaves an empty element attached to its parent, so a long
+    <Track> or <trkseg> would still grow by one node per point. lxml can
+    unlink them; the stdlib tree has no parent pointers, so there only
+    clear() applies.
+    """
+    elem.clear()
+    if hasattr(elem, "getprevious"):
+        while elem.getprevious() is not None:
+            del elem.getparent()[0]
+
+
+def parse_numbers(texts, dtype=np.float64):
+    """Convert a list of numeric strings with one bulk np.fromstring call."""
+    if not texts:
+        return np.empty(0, dtype=dtype)
+    out = np.fromstring(" ".join(texts), dtype=dtype, sep=" ")
+    if out.size != len(texts):
+        raise ValueError("malformed numeric value in track data")
+    return out
+
+
+class TrackBuf:
+    """Structure-of-arrays buffer for trackpoint samples.
+
+    Each column collects the raw text of its samples while the file is
+    parsed and is converted in bulk when read. lon/lat hold one entry per
+    point; alt, hr and cad only hold the samples that were present.
+    """
+    __slots__ = ("lon", "lat", "alt", "hr", "cad")
+
+    def __init__(self):
+        self.lon = []
+        self.lat = []
+        self.alt = []
+        self.hr  = []
+        self.cad = []
+
+    def coords(self):
+        """(N, 2) float64 array of [lon, lat] pairs."""
+        return np.column_stack([parse_numbers(self.lon), parse_numbers(self.lat)])
+
+    def stats(self):
+        """(elevation_gain, avg_hr, max_hr) over the buffered samples."""
+        return elev_and_hr(parse_numbers(self.alt), parse_numbers(self.hr, np.int64))
+
+
+@njit(cache=True)
+def _elev_and_hr_jit(alts, hrs):
+    """One pass over altitude (float64) and heart-rate (int64) samples.
+
+    Returns (elevation_gain, avg_hr, max_hr); the HR values are NaN when
+    there are no samples.
+    """
+    gain = 0.0
+    for i in range(1, alts.size):
+        d = alts[i] - alts[i - 1]
+        if d > 0:
+            gain += d
+
+    if hrs.size == 0:
+        return gain, np.nan, np.nan
+    hr_sum = 0.0
+    hr_max = hrs[0]
+    for i in range(hrs.size):
+        hr_sum += hrs[i]
+        if hrs[i] > hr_max:
+            hr_max = hrs[i]
+    return gain, hr_sum / hrs.size, float(hr_max)
+
+
+EARTH_RADIUS_M = 6378.137 * 1000
+ONE_DEGREE_M   = (2 * math.pi * EARTH_RADIUS_M) / 360
+
+
+@njit(cache=True)
+def track_length_2d(lats, lons):
+    """2D length in metres of one track segment.
+
+    Uses the same rule as gpxpy's length_2d(): a flat-earth approximation
+    for hops under 0.2 degrees, haversine for anything longer.
+    """
+    total = 0.0
+    for i in range(1, lats.size):
+        lat1, lon1 = lats[i - 1], lons[i - 1]
+        lat2, lon2 = lats[i], lons[i]
+        if abs(lat1 - lat2) > 0.2 or abs(lon1 - lon2) > 0.2:
+            r1, r2 = math.radians(lat1), math.radians(lat2)
+            a = (math.sin((r1 - r2) / 2) ** 2 +
+                 math.sin(math.radians(lon1 - lon2) / 2) ** 2 * math.cos(r1) * math.cos(r2))
+            total += EARTH_RADIUS_M * 2 * math.asin(math.sqrt(a))
+        else:
+            x = lat1 - lat2
+            y = (lon1 - lon2) * math.cos(math.radians(lat2))
+            total += math.sqrt(x * x + y * y) * ONE_DEGREE_M
+    return total
+
+
+SEMICIRCLE_DEG = 180.0 / 2**31     # FIT position units -> degrees
+
+
+@njit(cache=True)
+def _fit_reduce_jit(lat_i, lon_i, alts, hrs):
+    """All per-record numeric work for a FIT file in one compiled call.
+
+    Takes int32 semicircle positions plus float64 altitude and int64 HR
+    samples; returns (coords, elevation_gain, avg_hr, max_hr) where coords
+    is an (N, 2) float64 array of [lon, lat] degrees.
+    """
+    coords = np.empty((lat_i.size, 2))
+    for i in range(lat_i.size):
+        coords[i, 0] = lon_i[i] * SEMICIRCLE_DEG
+        coords[i, 1] = lat_i[i] * SEMICIRCLE_DEG
+    gain, hr_mean, hr_max = _elev_and_hr_jit(alts, hrs)
+    return coords, gain, hr_mean, hr_max
+
+
+def _elev_and_hr_numpy(alts, hrs):
+    """Vectorized elev_and_hr for when the loops cannot be compiled."""
+    gain = float(np.maximum(np.diff(alts), 0.0).sum()) if alts.size > 1 else 0.0
+    if hrs.size == 0:
+        return gain, np.nan, np.nan
+    return gain, float(hrs.mean()), float(hrs.max())
+
+
+def _fit_reduce_numpy(lat_i, lon_i, alts, hrs):
+    coords = np.column_stack([lon_i * SEMICIRCLE_DEG, lat_i * SEMICIRCLE_DEG])
+    return (coords,) + _elev_and_hr_numpy(alts, hrs)
+
+
+# Public entry points: the compiled loops with numba, NumPy otherwise
+if HAVE_NUMBA:
+    elev_and_hr = _elev_and_hr_jit
+    fit_reduce  = _fit_reduce_jit
+else:
+    elev_and_hr = _elev_and_hr_numpy
+    fit_reduce  = _fit_reduce_numpy
@@ -1,93 +1,78 @@
+import io
 import os
+import array
 import json
 import gzip
-import xml.etree.ElementTree as ET
+try:
+    from lxml import etree as ET    # libxml2-backed, same iterparse API
+except ImportError:
+    import xml.etree.ElementTree as ET
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
-import gpxpy
+from functools import lru_cache, partial
+import numpy as np
+import orjson
 from fitparse import FitFile
+import tcx_parser
+from _kernels import fit_reduce, release_element, track_length_2d
 
 RAW_DIR     = "raw"
 OUT_INDEX   = "activity_index.json"
 OUT_GEOJSON = "segments.geojson"
 
 # ── UTILITY: Normalize sport values ─────────────────────────────────────────────
+_SPORT_MAP = {"cycling": "Biking", "bike": "Biking", "biking": "Biking",
+              "running": "Running"}
+
+@lru_cache(maxsize=128)
 def normalize_sport(raw_sport):
-    s = (raw_sport or "").strip().lower()
-    if s in ("cycling", "bike", "biking"):   return "Biking"
-    if s in ("running",):                       return "Running"
-    return raw_sport.title() if raw_sport else "Unknown"
+    if not raw_sport:
+        return "Unknown"
+    return _SPORT_MAP.get(raw_sport.strip().lower()) or raw_sport.title()
 
 # ── PARSE TCX ───────────────────────────────────────────────────────────────────
 def parse_tcx(path):
-    ns = {"t": "http://www.garmin.com/xmlschemas/TrainingCenterDatabase/v2"}
-    tree = ET.parse(path)
-    root = tree.getroot()
-
-    # Sport metadata
-    raw_sport = root.find(".//t:Activity", ns).get("Sport", "Unknown")
-    meta = {"activityId": os.path.basename(path), "sport": normalize_sport(raw_sport)}
-
-    laps = root.findall(".//t:Lap", ns)
-    total_time = sum(float(l.get("TotalTimeSeconds","0")) for l in laps)
-    distance   = sum(float(l.get("DistanceMeters","0"))     for l in laps)
-    calories   = sum(int(l.findtext("t:Calories","0",ns))    for l in laps)
-
-    avg_hrs = [int(l.find(".//t:AverageHeartRateBpm/t:Value",ns).text)
-               for l in laps if l.find(".//t:AverageHeartRateBpm/t:Value",ns) is not None]
-    max_hrs = [int(l.find(".//t:MaximumHeartRateBpm/t:Value",ns).text)
-               for l in laps if l.find(".//t:MaximumHeartRateBpm/t:Value",ns) is not None]
-    avg_hr = sum(avg_hrs)/len(avg_hrs) if avg_hrs else None
-    max_hr = max(max_hrs) if max_hrs else None
-
-    pts, prev_elev, elev_gain = [], None, 0.0
-    for tp in root.findall(".//t:Trackpoint", ns):
-        t = tp.find("t:Time", ns)
-        pos = tp.find("t:Position", ns)
-        ele = tp.findtext("t:AltitudeMeters", namespaces=ns)
-        if pos is None or t is None: continue
-        lat = float(pos.find("t:LatitudeDegrees",ns).text)
-        lon = float(pos.find("t:LongitudeDegrees",ns).text)
-        pts.append([lon, lat])
-        if ele is not None:
-            e = float(ele)
-            if prev_elev is not None and e > prev_elev:
-                elev_gain += e - prev_elev
-            prev_elev = e
-
-    avg_pace_s = (total_time/(distance/1000)) if distance else None
-    meta.update({
-        "start_time":      laps[0].get("StartTime"),
-        "duration_s":      total_time,
-        "distance_m":      distance,
-        "calories":        calories,
-        "avg_hr":          round(avg_hr,1) if avg_hr else None,
-        "max_hr":          max_hr,
-        "elevation_gain_m":round(elev_gain,1),
-        "avg_pace_s":      round(avg_pace_s,1) if avg_pace_s else None
-    })
+    meta, pts = tcx_parser.parse_tcx(path)
+    meta["sport"] = normalize_sport(meta["sport"])
+    # HR here comes from the lap summaries, and elevation gain is always a number
+    meta["avg_hr"] = meta.pop("lap_avg_hr") or None
+    meta["max_hr"] = meta.pop("lap_max_hr")
+    if meta["elevation_gain_m"] is None:
+        meta["elevation_gain_m"] = 0.0
+    for k in ("avg_hr", "elevation_gain_m", "avg_pace_s", "cadence"):
+        if meta[k] is not None:
+            meta[k] = round(meta[k], 1)
     return meta, pts
 
 # ── PARSE GPX ───────────────────────────────────────────────────────────────────
 def parse_gpx(path):
-    raw_bytes = open(path, "rb").read()
-    text = raw_bytes.decode("utf-8", errors="replace")
-    gpx = gpxpy.parse(text)
-
-    pts = []
-    for tr in gpx.tracks:
-        for seg in tr.segments:
-            for p in seg.points:
-                pts.append([p.longitude, p.latitude])
-
-    start = gpx.tracks[0].segments[0].points[0].time
-    distance = gpx.length_2d()
+    # Stream <trkpt lat lon> directly; works for GPX 1.0 and 1.1 namespaces
+    lats, lons = array.array("d"), array.array("d")
+    seg_start, distance, start = 0, 0.0, None
+    for _, elem in ET.iterparse(path, events=("end",)):
+        ns, _, name = elem.tag.rpartition("}")
+        if name == "trkpt":
+            lats.append(float(elem.get("lat")))
+            lons.append(float(elem.get("lon")))
+            if len(lats) == 1:
+                start = elem.findtext(ns + "}time" if ns else "time")
+            release_element(elem)
+        elif name == "trkseg":
+            # gpxpy's length_2d() sums segments without joining them
+            distance += track_length_2d(np.frombuffer(lats, dtype=np.float64)[seg_start:],
+                                        np.frombuffer(lons, dtype=np.float64)[seg_start:])
+            seg_start = len(lats)
+            release_element(elem)
+
+    pts = np.column_stack([np.frombuffer(lons, dtype=np.float64),
+                           np.frombuffer(lats, dtype=np.float64)])
     raw_sport = "Running" if "run" in path.lower() else "Biking"
     meta = {
         "activityId":      os.path.basename(path),
         "sport":           normalize_sport(raw_sport),
-        "start_time":      start.isoformat(),
+        "start_time":      datetime.fromisoformat(start).isoformat() if start else None,
         "duration_s":      None,
-        "distance_m":      distance,
+        "distance_m":      float(distance),
         "calories":        None,
         "avg_hr":          None,
         "max_hr":          None,
@@ -96,23 +81,35 @@ def parse_gpx(path):
     }
     return meta, pts
 
+# ── OPEN FIT / FIT.GZ ───────────────────────────────────────────────────────────
+GZIP_BUFFER_SIZE = 1 << 20
+
+# Python 3.12+ sizes GzipFile's internal read buffer from this module global
+if hasattr(gzip, "READ_BUFFER_SIZE"):
+    gzip.READ_BUFFER_SIZE = GZIP_BUFFER_SIZE
+
+def _open_maybe_gz(path, compressed):
+    if not compressed:
+        return open(path, "rb")
+    return io.BufferedReader(gzip.open(path, "rb"), buffer_size=GZIP_BUFFER_SIZE)
+
 # ── PARSE FIT / FIT.GZ ──────────────────────────────────────────────────────────
 def parse_fit(path, compressed=False):
-    fobj = gzip.open(path, "rb") if compressed else open(path, "rb")
+    fobj = _open_maybe_gz(path, compressed)
     fit = FitFile(fobj)
-    pts = []
+    lat_buf, lon_buf = array.array("i"), array.array("i")
     meta = {k: None for k in [
         "activityId","sport","start_time","duration_s","distance_m",
         "calories","avg_hr","max_hr","elevation_gain_m","avg_pace_s","cadence"
     ]}
     meta["activityId"] = os.path.basename(path)
 
-    hr_samples, prev_elev, elev_gain = [], None, 0.0
+    hr_samples, alts = array.array("q"), array.array("d")
     for msg in fit.get_messages("record"):
         vals = msg.get_values()
         lat, lon = vals.get("position_lat"), vals.get("position_long")
         if lat and lon:
-            pts.append([lon*(180/(2**31)), lat*(180/(2**31))])
+            lat_buf.append(lat); lon_buf.append(lon)
         ts = vals.get("timestamp")
         if ts and not meta["start_time"]:
             meta["start_time"] = ts.isoformat()
@@ -122,9 +119,7 @@ def parse_fit(path, compressed=False):
             hr_samples.append(vals.get("heart_rate"))
         ele = vals.get("enhanced_altitude") or vals.get("altitude")
         if ele is not None:
-            if prev_elev is not None and ele>prev_elev:
-                elev_gain += ele-prev_elev
-            prev_elev = ele
+            alts.append(ele)
         if vals.get("cadence"):
             meta["cadence"] = vals.get("cadence")
 
@@ -137,11 +132,15 @@ def parse_fit(path, compressed=False):
         if v.get("total_calories") and not meta["calories"]:
             meta["calories"] = v.get("total_calories")
 
+    # Coordinate conversion, elevation gain and HR stats in one kernel call
+    pts, elev_gain, avg_hr, max_hr = fit_reduce(
+        np.frombuffer(lat_buf, dtype=np.int32), np.frombuffer(lon_buf, dtype=np.int32),
+        np.frombuffer(alts, dtype=np.float64), np.frombuffer(hr_samples, dtype=np.int64))
     if hr_samples:
-        meta["avg_hr"] = round(sum(hr_samples)/len(hr_samples),1)
-        meta["max_hr"] = max(hr_samples)
+        meta["avg_hr"] = round(float(avg_hr),1)
+        meta["max_hr"] = int(max_hr)
     if elev_gain:
-        meta["elevation_gain_m"] = round(elev_gain,1)
+        meta["elevation_gain_m"] = round(float(elev_gain),1)
     if meta.get("distance_m") and meta.get("duration_s"):
         meta["avg_pace_s"] = round(meta["duration_s"]/ (meta["distance_m"]/1000),1)
 
@@ -161,29 +160,91 @@ def load_json_meta(path):
         meta.setdefault(k, None)
     return meta, None
 
-# ── MAIN PROCESS ────────────────────────────────────────────────────────────────
-features = []
-index    = []
-for fname in os.listdir(RAW_DIR):
+# ── DISPATCH BY FILE SUFFIX ────────────────────────────────────────────────────
+DISPATCH = {
+    ".tcx":    parse_tcx,
+    ".gpx":    parse_gpx,
+    ".fit":    partial(parse_fit, compressed=False),
+    ".fit.gz": partial(parse_fit, compressed=True),
+    ".json":   load_json_meta,
+}
+
+def file_suffix(fname):
     lower = fname.lower()
-    path  = os.path.join(RAW_DIR, fname)
+    return ".fit.gz" if lower.endswith(".fit.gz") else os.path.splitext(lower)[1]
+
+# ── PARSE ONE FILE (runs in a worker process) ──────────────────────────────────
+def parse_one(path):
+    fname = os.path.basename(path)
     try:
-        if   lower.endswith(".tcx"):      m, pts = parse_tcx(path)
-        elif lower.endswith(".gpx"):      m, pts = parse_gpx(path)
-        elif lower.endswith(".fit"):      m, pts = parse_fit(path, compressed=False)
-        elif lower.endswith(".fit.gz"):   m, pts = parse_fit(path, compressed=True)
-        elif lower.endswith(".json"):     m, pts = load_json_meta(path)
-        else: continue
-        index.append(m)
-        if pts:
-            features.append({
-                "type": "Feature",
-                "geometry": {"type":"LineString","coordinates":pts},
-                "properties": m
-            })
+        m, pts = DISPATCH[file_suffix(fname)](path)
     except Exception as e:
-        print(f"Failed to parse {fname}: {e}")
-with open(OUT_INDEX,   "w") as f: json.dump(index, f, indent=2)
-with open(OUT_GEOJSON, "w") as f:
-    json.dump({"type":"FeatureCollection","features":features}, f, indent=2)
-print(f"✅ Wrote {len(index)} metadata entries and {len(features)} geo features.")
+        # Send back text: some parser errors (e.g. lxml's) can't be pickled
+        return fname, None, None, f"{type(e).__name__}: {e}"
+    return fname, m, pts, None
+
+# ── PREVIOUS RUN (incremental cache) ───────────────────────────────────────────
+def _cache_key(meta):
+    # Raw file name the entry came from; activityId for entries without one
+    if not isinstance(meta, dict):
+        return None
+    return meta.get("_source") or meta.get("activityId")
+
+def load_previous():
+    """Index entries and features from the last run, keyed by source file name."""
+    try:
+        with open(OUT_INDEX,   "rb") as f: prev_index = orjson.loads(f.read())
+        with open(OUT_GEOJSON, "rb") as f: prev_feats = orjson.loads(f.read())
+    except (OSError, orjson.JSONDecodeError):
+        return {}, {}
+    if not isinstance(prev_index, list) or not isinstance(prev_feats, dict):
+        return {}, {}
+    by_file = {_cache_key(e): e for e in prev_index}
+    feats = {_cache_key(ft.get("properties")): ft
+             for ft in prev_feats.get("features", []) if isinstance(ft, dict)}
+    by_file.pop(None, None)
+    feats.pop(None, None)
+    return by_file, feats
+
+# ── MAIN PROCESS ────────────────────────────────────────────────────────────────
+if __name__ == "__main__":
+    features = []
+    index    = []
+    # Files whose mtime matches the last run are taken from the previous outputs
+    prev_index, prev_features = load_previous()
+    todo = {}
+    with os.scandir(RAW_DIR) as it:
+        for e in it:
+            if not (e.is_file() and file_suffix(e.name) in DISPATCH):
+                continue
+            mtime = e.stat().st_mtime
+            cached = prev_index.get(e.name)
+            if cached is not None and cached.get("_mtime") == mtime:
+                index.append(cached)
+                if e.name in prev_features:
+                    features.append(prev_features[e.name])
+            else:
+                todo[e.path] = mtime
+    reused = len(index)
+    with ProcessPoolExecutor(max_workers=os.cpu_count()) as ex:
+        results = ex.map(parse_one, todo, chunksize=4)
+        for (fname, m, pts, err), mtime in zip(results, todo.values()):
+            if err is not None:
+                print(f"Failed to parse {fname}: {err}")
+                continue
+            m["_source"], m["_mtime"] = fname, mtime
+            index.append(m)
+            if pts is not None and len(pts):
+                # coordinates stay an (N, 2) ndarray; orjson serializes it natively
+                features.append({
+                    "type": "Feature",
+                    "geometry": {"type":"LineString","coordinates":pts},
+                    "properties": m
+                })
+    # The index stays pretty-printed for humans; the large GeoJSON is compact
+    opts = orjson.OPT_SERIALIZE_NUMPY
+    with open(OUT_INDEX,   "wb") as f: f.write(orjson.dumps(index, option=opts | orjson.OPT_INDENT_2))
+    with open(OUT_GEOJSON, "wb") as f:
+        f.write(orjson.dumps({"type":"FeatureCollection","features":features}, option=opts))
+    print(f"✅ Wrote {len(index)} metadata entries and {len(features)} geo features "
+          f"({reused} unchanged).")
@@ -15,65 +15,58 @@ Usage:
 """
 
 import os
-import json
-import xml.etree.ElementTree as ET
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from pathlib import Path
-from shapely.geometry import LineString, mapping
+import shapely
 import numpy as np
+import orjson
+import tcx_parser
 
 def parse_tcx(file_path):
-    ns = {'tcx': 'http://www.garmin.com/xmlschemas/TrainingCenterDatabase/v2'}
-    tree = ET.parse(file_path)
-    root = tree.getroot()
-
-    # Sport from Activity tag
-    activity = root.find('.//tcx:Activity', ns)
-    sport = activity.attrib.get('Sport', 'Other') if activity is not None else 'Other'
-
-    coords, hrs, alts, cads = [], [], [], []
-    total_dist = total_sec = total_cal = 0.0
-    start_time = None
-
-    laps = root.findall('.//tcx:Lap', ns)
-    for lap in laps:
-        if start_time is None:
-            start_time = lap.attrib.get('StartTime')
-        total_dist += float(lap.findtext('tcx:DistanceMeters', '0', ns))
-        total_sec  += float(lap.findtext('tcx:TotalTimeSeconds', '0', ns))
-        total_cal  += float(lap.findtext('tcx:Calories', '0', ns))
-
-        for tp in lap.findall('.//tcx:Trackpoint', ns):
-            lat = tp.findtext('tcx:Position/tcx:LatitudeDegrees', None, ns)
-            lon = tp.findtext('tcx:Position/tcx:LongitudeDegrees', None, ns)
-            if lat and lon:
-                coords.append((float(lon), float(lat)))
-                hr = tp.findtext('tcx:HeartRateBpm/tcx:Value', None, ns)
-                if hr:  hrs.append(int(hr))
-                alt = tp.findtext('tcx:AltitudeMeters', None, ns)
-                if alt: alts.append(float(alt))
-                cad = tp.findtext('tcx:Cadence', None, ns)
-                if cad: cads.append(int(cad))
-
-    avg_hr = int(np.mean(hrs)) if hrs else None
-    max_hr = int(np.max(hrs)) if hrs else None
-    elevation_gain = float(np.sum(np.diff(alts)[np.diff(alts) > 0])) if len(alts) > 1 else None
-    avg_cadence = int(np.mean(cads)) if cads else None
-    avg_pace_s = (total_sec / (total_dist / 1000)) if total_dist > 0 else None
-
-    return {
+    try:
+        meta, coords = tcx_parser.parse_tcx(file_path)
+    except Exception as e:
+        # Runs in a worker: lxml errors can't be pickled back to the parent
+        raise ValueError(f"{file_path.name}: {type(e).__name__}: {e}") from None
+    del meta['lap_avg_hr'], meta['lap_max_hr']
+    avg_hr, cadence = meta['avg_hr'], meta['cadence']
+    meta.update({
         'activityId': file_path.stem,
-        'start_time': start_time,
-        'sport': sport,
-        'distance_m': total_dist,
-        'duration_s': total_sec,
-        'avg_hr': avg_hr,
-        'max_hr': max_hr,
-        'avg_pace_s': avg_pace_s,
-        'elevation_gain_m': elevation_gain,
-        'cadence': avg_cadence,
-        'calories': total_cal,
-        'coordinates': coords
-    }
+        'sport': meta['sport'] or 'Other',
+        'avg_hr': int(avg_hr) if avg_hr is not None else None,
+        'cadence': int(cadence) if cadence is not None else None,
+        'coordinates': coords,
+        '_mtime': file_path.stat().st_mtime
+    })
+    return meta
+
+def _load_cached(tcx_file, geojson_dir, metadata_dir):
+    """(meta, feature bytes) from a previous run if tcx_file is unchanged, else None."""
+    try:
+        meta = orjson.loads((metadata_dir / f"{tcx_file.stem}.json").read_bytes())
+        feat = (geojson_dir / f"{tcx_file.stem}.geojson").read_bytes()
+    except (FileNotFoundError, ValueError):
+        return None
+    if meta.get('_mtime') != tcx_file.stat().st_mtime:
+        return None
+    return meta, feat
+
+def _write_json(path, obj):
+    path.write_bytes(orjson.dumps(obj, option=orjson.OPT_SERIALIZE_NUMPY))
+
+def _feature_bytes(geometry, properties):
+    # geometry is already GeoJSON text from shapely.to_geojson
+    return (b'{"type":"Feature","geometry":' + geometry.encode() +
+            b',"properties":' + orjson.dumps(properties) + b'}')
+
+def _linestrings_geojson(coord_arrays):
+    """GeoJSON text for one LineString per (N, 2) array, built in a single batch."""
+    if not coord_arrays:
+        return []
+    lens = [len(c) for c in coord_arrays]
+    geoms = shapely.linestrings(np.vstack(coord_arrays),
+                                indices=np.repeat(np.arange(len(coord_arrays)), lens))
+    return shapely.to_geojson(geoms).tolist()
 
 def main():
     raw_dir = Path('raw')
@@ -86,37 +79,50 @@ def main():
     segments = []
     index = []
 
+    # Reuse the per-activity outputs of files that haven't changed since
+    tcx_files = []
     for tcx_file in raw_dir.glob('*.tcx'):
-        data = parse_tcx(tcx_file)
-        if len(data['coordinates']) < 2:
+        cached = _load_cached(tcx_file, geojson_dir, metadata_dir)
+        if cached is None:
+            tcx_files.append(tcx_file)
             continue
+        index.append(cached[0])
+        segments.append(cached[1])
+    reused = len(segments)
 
-        # Create GeoJSON feature
-        feat = {
-            'type': 'Feature',
-            'geometry': mapping(LineString(data['coordinates'])),
-            'properties': {'activityId': data['activityId']}
-        }
+    with ProcessPoolExecutor(max_workers=os.cpu_count()) as ex:
+        results = list(ex.map(parse_tcx, tcx_files, chunksize=4))
 
-        # Write individual geojson
-        with open(geojson_dir / f"{data['activityId']}.geojson", 'w') as f:
-            json.dump(feat, f)
+    results = [data for data in results if len(data['coordinates']) >= 2]
+    geometries = _linestrings_geojson([data['coordinates'] for data in results])
 
-        # Prepare and write metadata
-        meta = {k: v for k, v in data.items() if k != 'coordinates'}
-        with open(metadata_dir / f"{data['activityId']}.json", 'w') as f:
-            json.dump(meta, f)
+    # Per-activity files are small and I/O bound, so overlap their writes
+    writes = []
+    with ThreadPoolExecutor(max_workers=16) as pool:
+        for data, geometry in zip(results, geometries):
+            # Create GeoJSON feature
+            feat = _feature_bytes(geometry, {'activityId': data['activityId']})
 
-        segments.append(feat)
-        index.append(meta)
+            # Prepare metadata
+            meta = {k: v for k, v in data.items() if k != 'coordinates'}
+
+            # Write individual geojson and metadata
+            writes.append(pool.submit((geojson_dir / f"{data['activityId']}.geojson").write_bytes, feat))
+            writes.append(pool.submit(_write_json, metadata_dir / f"{data['activityId']}.json", meta))
+
+            segments.append(feat)
+            index.append(meta)
+    for w in writes:
+        w.result()    # re-raise any write error
 
     # Write merged outputs
-    with open('segments.geojson', 'w') as f:
-        json.dump({'type': 'FeatureCollection', 'features': segments}, f)
-    with open('activity_index.json', 'w') as f:
-        json.dump(index, f)
+    opts = orjson.OPT_SERIALIZE_NUMPY
+    with open('segments.geojson', 'wb') as f:
+        f.write(b'{"type":"FeatureCollection","features":[' + b','.join(segments) + b']}')
+    with open('activity_index.json', 'wb') as f:
+        f.write(orjson.dumps(index, option=opts))
 
-    print(f"Processed {len(segments)} activities.")
+    print(f"Processed {len(segments)} activities ({reused} unchanged).")
     print("Outputs written to segments.geojson and activity_index.json")
 
 if __name__ == '__main__':
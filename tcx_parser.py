@@ -0,0 +1,94 @@
+"""
+tcx_parser.py
+
+Streaming parser for Garmin TCX files, shared by normalise_strava.py and
+preprocess_tcx.py. parse_tcx() returns the raw summary numbers; callers
+apply their own rounding, sport naming and activity ids.
+"""
+
+import os
+try:
+    from lxml import etree as ET    # libxml2-backed, same iterparse API
+except ImportError:
+    import xml.etree.ElementTree as ET
+import numpy as np
+from _kernels import TrackBuf, parse_numbers, release_element
+
+TCX_NS = "{http://www.garmin.com/xmlschemas/TrainingCenterDatabase/v2}"
+# Fully-qualified tag names, resolved once instead of per find()
+TAG = {name: TCX_NS + name for name in (
+    "Activity", "Lap", "TotalTimeSeconds", "DistanceMeters", "Calories",
+    "Trackpoint", "Position", "LatitudeDegrees", "LongitudeDegrees",
+    "AltitudeMeters", "HeartRateBpm", "Value", "Cadence",
+    "AverageHeartRateBpm", "MaximumHeartRateBpm",
+)}
+
+def _child_text(elem, outer, inner):
+    child = elem.find(outer)
+    return child.findtext(inner) if child is not None else None
+
+def parse_tcx(path):
+    """Parse a .tcx file into (meta, coords).
+
+    coords is an (N, 2) float64 array of [lon, lat]. meta["sport"] is the
+    raw Activity Sport attribute (None if missing); avg_hr, max_hr and
+    cadence come from the trackpoint samples, lap_avg_hr/lap_max_hr from the
+    per-lap summaries.
+    """
+    sport, start_time = None, None
+    total_time = distance = 0.0
+    calories = 0
+    lap_avg_hrs, lap_max_hrs = [], []
+    tb = TrackBuf()
+
+    # Stream the file once; each Trackpoint/Lap is consumed on its end event
+    # and released, so under lxml memory stays flat regardless of file size.
+    for _, elem in ET.iterparse(path, events=("end",)):
+        tag = elem.tag
+        if tag == TAG["Trackpoint"]:
+            pos = elem.find(TAG["Position"])
+            lat = pos.findtext(TAG["LatitudeDegrees"]) if pos is not None else None
+            lon = pos.findtext(TAG["LongitudeDegrees"]) if pos is not None else None
+            if lat and lon:
+                tb.lon.append(lon)
+                tb.lat.append(lat)
+                hr = _child_text(elem, TAG["HeartRateBpm"], TAG["Value"])
+                if hr:  tb.hr.append(hr)
+                alt = elem.findtext(TAG["AltitudeMeters"])
+                if alt: tb.alt.append(alt)
+                cad = elem.findtext(TAG["Cadence"])
+                if cad: tb.cad.append(cad)
+            release_element(elem)
+        elif tag == TAG["Lap"]:
+            if start_time is None:
+                start_time = elem.get("StartTime")
+            total_time += float(elem.findtext(TAG["TotalTimeSeconds"], "0"))
+            distance   += float(elem.findtext(TAG["DistanceMeters"], "0"))
+            calories   += int(elem.findtext(TAG["Calories"], "0"))
+            avg = _child_text(elem, TAG["AverageHeartRateBpm"], TAG["Value"])
+            if avg is not None: lap_avg_hrs.append(int(avg))
+            mx = _child_text(elem, TAG["MaximumHeartRateBpm"], TAG["Value"])
+            if mx is not None:  lap_max_hrs.append(int(mx))
+            release_element(elem)
+        elif tag == TAG["Activity"]:
+            if sport is None:
+                sport = elem.get("Sport")
+            release_element(elem)
+
+    gain, avg_hr, max_hr = tb.stats()
+    meta = {
+        "activityId":       os.path.basename(path),
+        "sport":            sport,
+        "start_time":       start_time,
+        "duration_s":       total_time,
+        "distance_m":       distance,
+        "calories":         calories,
+        "avg_hr":           float(avg_hr) if tb.hr else None,
+        "max_hr":           int(max_hr) if tb.hr else None,
+        "elevation_gain_m": float(gain) if len(tb.alt) > 1 else None,
+        "avg_pace_s":       total_time / (distance / 1000) if distance > 0 else None,
+        "cadence":          float(parse_numbers(tb.cad, np.int64).mean()) if tb.cad else None,
+        "lap_avg_hr":       sum(lap_avg_hrs) / len(lap_avg_hrs) if lap_avg_hrs else None,
+        "lap_max_hr":       max(lap_max_hrs) if lap_max_hrs else None,
+    }
+    return meta, tb.coords()